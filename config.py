@@ -10,9 +10,16 @@ Created on Sun Dec 27 18:18:23 2020
 class Config:
     def __init__(self, filename: str = ".api_keys"):
         """
-        Read the config from a file.
+        Read the config from a file of KEY=value lines.
+
+        Blank lines and lines starting with # are ignored,
+        and values may themselves contain an =.
         """
         with open(filename, "r") as fi:
-            for line in fi:
-                key, val = line.split("=")
-                setattr(self, key.strip(), val.strip())
+            text = fi.read()
+        parsed = dict(
+            line.split("=", 1)
+            for line in text.splitlines()
+            if line.strip() and not line.lstrip().startswith("#")
+        )
+        self.__dict__.update({key.strip(): val.strip() for key, val in parsed.items()})
@@ -10,8 +10,11 @@ import schedule
 import time
 from collections import defaultdict
 import datetime
+import logging
+from pathlib import Path
 from threading import Thread
 import sys
+from typing import Dict, Tuple
 
 try:
     import rpi_ws281x as ws
@@ -24,41 +27,68 @@ from flask import Flask, render_template, flash, redirect
 
 from config import Config
 from time_form import TimeForm
-from led_animations import sunrise_animation, alternate_colors
+from led_animations import clear
 from weather_animations import weather_animations
 
-logger = logging.get_logger(__name__)
+logger = logging.getLogger(__name__)
 
 CONFIG = Config()
 
 NUM_LEDS = 150
 LED_PIN = 18
 RUNTIME = 20 * 60
+PREFETCH_TIME = 30
 STRIP = ws.PixelStrip(NUM_LEDS, LED_PIN)
 
 app = Flask(__name__)
 app.config.from_object(CONFIG)
 
 
+_WEATHER_CACHE: Dict[str, Tuple[float, str]] = {}
+_OWM_CLIENT = None
+_WEATHER_MANAGER = None
+
+
+def _get_weather_manager():
+    """
+    Get the OpenWeatherMap weather manager, creating it the first time we need it.
+
+    Keeping the one manager around lets its HTTP session reuse connections.
+    """
+    global _OWM_CLIENT, _WEATHER_MANAGER
+    if _WEATHER_MANAGER is None:
+        _OWM_CLIENT = OWM(CONFIG.WEATHER_API_KEY)
+        _WEATHER_MANAGER = _OWM_CLIENT.weather_manager()
+    return _WEATHER_MANAGER
+
+
 def get_weather(location: str = "Oxford,GB") -> str:
     """
     Get the weather from OpenWeatherMap
 
+    Results are cached for CONFIG.WEATHER_TTL seconds (default 600) so that
+    we don't wait on a network round trip when the alarm goes off.
+
     :param location: an owm location string to get weather data for
 
     :return: the simple weather status
     """
-    try:
-        owm = OWM(CONFIG.WEATHER_API_KEY)
+    ttl = float(getattr(CONFIG, "WEATHER_TTL", 600))
+    if location in _WEATHER_CACHE:
+        fetched_at, status = _WEATHER_CACHE[location]
+        if time.time() - fetched_at < ttl:
+            return status
 
-        mgr = owm.weather_manager()
-        observation = mgr.weather_at_place(
-            "Oxford,GB"
+    try:
+        observation = _get_weather_manager().weather_at_place(
+            location
         )  # the observation object is a box containing a weather object
-        return observation.weather.status
+        status = observation.weather.status
     except Exception as ex:
         print(f"Failed to get the weather: {ex}", file=sys.stderr)
         return None
+    _WEATHER_CACHE[location] = (time.time(), status)
+    return status
 
 
 def turn_lights_on(strip: ws.PixelStrip, runtime: float = RUNTIME):
@@ -74,11 +104,29 @@ def turn_lights_off(strip: ws.PixelStrip, runtime: float = RUNTIME):
     print(f"Turning the lights off over {runtime}s")
     weather = get_weather()
     weather_animations[weather](strip, runtime, reverse=True)
-    for i in range(strip.numPixels()):
-        strip.setPixelColor(i, ws.Color(0, 0, 0))
+    clear(strip)
     strip.show()
 
 
+def schedule_lights(on_time: datetime.time, off_time: datetime.time):
+    """
+    Schedule the lights to come on and go off every day.
+
+    Also fetch the weather shortly before the lights come on, so it is
+    already cached by the time we need it.
+
+    :param on_time: the time for the lights to come on
+    :param off_time: the time for the lights to go off
+    """
+    prefetch_time = (
+        datetime.datetime.combine(datetime.date.today(), on_time)
+        - datetime.timedelta(seconds=PREFETCH_TIME)
+    ).time()
+    schedule.every().day.at(prefetch_time.strftime("%H:%M:%S")).do(get_weather)
+    schedule.every().day.at(on_time.strftime("%H:%M:%S")).do(turn_lights_on, STRIP)
+    schedule.every().day.at(off_time.strftime("%H:%M:%S")).do(turn_lights_off, STRIP)
+
+
 @app.route("/", methods=["GET", "POST"])
 def change_time():
     """
@@ -101,14 +149,9 @@ def change_time():
         ).time()
 
         with open("./times.txt", "w") as fi:
-            fi.write(on_time.strftime("%H:%M:%S") + "\n")
-            fi.write(off_time.strftime("%H:%M:%S") + "\n")
-        schedule.every().day.at(on_time.strftime("%H:%M:%S")).do(turn_lights_on, STRIP)
-        schedule.every().day.at(off_time.strftime("%H:%M:%S")).do(
-            turn_lights_off, STRIP
-        )
-        for i in range(STRIP.numPixels()):
-            STRIP.setPixelColor(i, ws.Color(0, 0, 0))
+            fi.write(f"{on_time:%H:%M:%S}\n{off_time:%H:%M:%S}\n")
+        schedule_lights(on_time, off_time)
+        clear(STRIP)
         STRIP.show()
         flash(f"The lights will come on at {on_time.strftime('%H:%M:%S')}")
         print(f"The lights will come on at {on_time.strftime('%H:%M:%S')}")
@@ -117,17 +160,27 @@ def change_time():
 
 
 def check_schedule(sleep_time: int = 10):
+    """
+    Run any scheduled jobs, sleeping until the next one is due.
+
+    :param sleep_time: the longest we'll sleep between checks, in case the schedule changes
+    """
     while True:
         schedule.run_pending()
-        time.sleep(sleep_time)
+        idle_time = schedule.idle_seconds()
+        if idle_time is None:
+            idle_time = sleep_time
+        time.sleep(max(0, min(idle_time, sleep_time)))
 
 
 if __name__ == "__main__":
     STRIP.begin()
 
-    with open("./times.txt", "r") as fi:
-        schedule.every().day.at(fi.readline().strip()).do(turn_lights_on, STRIP)
-        schedule.every().day.at(fi.readline().strip()).do(turn_lights_off, STRIP)
+    on_line, off_line = Path("./times.txt").read_text().splitlines()[:2]
+    schedule_lights(
+        datetime.time.fromisoformat(on_line.strip()),
+        datetime.time.fromisoformat(off_line.strip()),
+    )
 
     thread = Thread(target=check_schedule, args=[60])
     thread.start()
@@ -4,14 +4,9 @@ https://tutorials-raspberrypi.com/connect-control-raspberry-pi-ws2812-rgb-led-st
 """
 
 from abc import ABC, abstractmethod
-from collections import deque
-import copy
-import random
 import time
 from typing import Optional, Iterable, Union
 
-import pandas as pd
-from PIL import Image
 import numpy as np
 
 try:
@@ -20,6 +15,103 @@ except ImportError:
     import ws_stub as ws
 
 
+def pack_rgb(red, green, blue) -> np.ndarray:
+    """
+    Pack red, green and blue channels into 24-bit colours, as ws.Color does.
+
+    Parameters
+    ----------
+    red, green, blue
+        Integer colour channels in the range [0, 255], as scalars or arrays
+
+    Returns
+    -------
+        uint32 array of packed colours
+    """
+    return (
+        (np.asarray(red, dtype=np.uint32) << 16)
+        | (np.asarray(green, dtype=np.uint32) << 8)
+        | np.asarray(blue, dtype=np.uint32)
+    )
+
+
+def unpack_rgb(colors) -> np.ndarray:
+    """
+    Split packed 24-bit colours back into their red, green and blue channels.
+
+    Parameters
+    ----------
+    colors
+        Packed colours, as a scalar or array
+
+    Returns
+    -------
+        int32 array with a trailing axis of length 3 for red, green and blue
+    """
+    colors = np.asarray(colors, dtype=np.uint32)
+    return np.stack(
+        [(colors >> 16) & 0xFF, (colors >> 8) & 0xFF, colors & 0xFF], axis=-1
+    ).astype(np.int32)
+
+
+def _lerp_table(old_colors, new_colors, steps: int) -> np.ndarray:
+    """
+    Linearly interpolate between two sets of packed colours, in integer arithmetic.
+
+    Parameters
+    ----------
+    old_colors
+        Packed colours to start from
+    new_colors
+        Packed colours to finish on
+    steps
+        Number of steps to take, including both ends
+
+    Returns
+    -------
+        (steps, N) uint32 array of packed colours, one row per step
+    """
+    old_rgb = unpack_rgb(old_colors)
+    delta = unpack_rgb(new_colors) - old_rgb
+    step_ids = np.arange(steps, dtype=np.int32)[:, None, None]
+    rgb = old_rgb + (delta * step_ids) // max(steps - 1, 1)
+    return pack_rgb(rgb[..., 0], rgb[..., 1], rgb[..., 2])
+
+
+def blit(strip: ws.PixelStrip, colors: Iterable[int]):
+    """
+    Write an array of colours into the strip, starting from the first pixel.
+
+    This goes through setPixelColor rather than slicing getPixels(), as newer
+    versions of rpi_ws281x return a copy of the pixels from getPixels().
+    Doesn't call strip.show().
+
+    Parameters
+    ----------
+    strip
+        The strip to write to
+    colors
+        24-bit RGB colours, one per pixel starting from the first.
+    """
+    set_pixel_color = strip.setPixelColor
+    for n, color in enumerate(np.asarray(colors, dtype=np.uint32).tolist()):
+        set_pixel_color(n, color)
+
+
+def clear(strip: ws.PixelStrip):
+    """
+    Turn every pixel on the strip off in one go. Doesn't call strip.show().
+
+    Parameters
+    ----------
+    strip
+        The strip to clear
+    """
+    set_pixel_color = strip.setPixelColor
+    for n in range(strip.numPixels()):
+        set_pixel_color(n, 0)
+
+
 class Frame:
     """
     Single frame to display on the image
@@ -41,18 +133,25 @@ class Frame:
             24-bit RGB colours to display. If just one colour, will repeat across the array.
         """
         self.strip = strip
+        self.num_pixels = strip.numPixels()
         try:
             iter(colors)
-            self.colors = np.asarray(colors, dtype=int)
+            self.colors = np.asarray(colors, dtype=np.uint32)
         except TypeError:
-            self.colors = np.array(
-                [colors for _ in range(self.strip.getNumPixels())], dtype=int
-            )
+            self.colors = np.full(self.num_pixels, colors, dtype=np.uint32)
+
+    def copy(self) -> "Frame":
+        """
+        Copy this frame's colours, sharing the same strip.
+        """
+        new_frame = Frame.__new__(Frame)
+        new_frame.strip = self.strip
+        new_frame.num_pixels = self.num_pixels
+        new_frame.colors = self.colors.copy()
+        return new_frame
 
     def show(self):
-        for i in range(self.strip.getNumPixels()):
-            if i < len(self.colors):
-                self.strip.setPixelColor(i, self.colors[i % len(self.colors)])
+        blit(self.strip, self.colors[: self.num_pixels])
         self.strip.show()
 
 
@@ -60,6 +159,8 @@ class Animation(ABC):
     def __init__(self, strip):
         self.strip = strip
         self.frame_number = 0
+        # Subclasses can fill this in place each frame instead of making a new one.
+        self.frame = Frame(strip, np.zeros(strip.numPixels(), dtype=np.uint32))
 
     def __iter__(self):
         self.frame_number = 0
@@ -77,16 +178,17 @@ class Animation(ABC):
         Parameters
         ----------
         delay
-            Time to wait between frames in ms
+            Time to wait between frames in s
         """
-        time_now = time.time()
+        # Aim for a fixed deadline for each frame, so that one slow frame
+        # doesn't push back all of the ones after it.
+        deadline = time.monotonic()
         for frame in self:
             frame.show()
-            time_after = time.time()
-            dt = time_after - time_now
-            # print(f"Showing F{self.frame_number} with dt={dt}")
-            time.sleep(delay - dt)
-            time_now = time.time()
+            deadline += delay
+            sleep_time = deadline - time.monotonic()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
 
 
 class AlternateColors(Animation):
@@ -104,21 +206,41 @@ class AlternateColors(Animation):
     def __init__(self, strip: ws.PixelStrip, colors: Optional[np.ndarray] = None):
         super().__init__(strip)
         if colors is not None:
-            self.color_arr = colors
+            self.color_arr = np.asarray(colors, dtype=np.uint32)
         else:
             self.color_arr = np.array(
                 [ws.Color(255, 0, 0), ws.Color(0, 255, 0), ws.Color(0, 0, 255)]
             )
 
+        self.color_ids = np.arange(self.strip.numPixels()) % len(self.color_arr)
+
     def __next__(self):
         super().__next__()
-        return Frame(
-            self.strip,
-            [
-                self.color_arr[(i + self.frame_number) % len(self.color_arr)]
-                for i in range(self.strip.getNumPixels())
-            ],
+        # Rotate the colours rather than the indices, as there are far fewer of them.
+        np.take(
+            np.roll(self.color_arr, -self.frame_number),
+            self.color_ids,
+            out=self.frame.colors,
         )
+        return self.frame
+
+
+def _build_rainbow_lut() -> np.ndarray:
+    """
+    Build the packed rainbow colour for every position from 0 to 255.
+    """
+    pos = np.arange(256)
+    red = np.where(
+        pos < 85, pos * 3, np.where(pos < 170, 255 - (pos - 85) * 3, (pos - 170) * 3)
+    )
+    green = np.where(
+        pos < 85, 255 - pos * 3, np.where(pos < 170, 0, 255 - (pos - 170) * 3)
+    )
+    blue = np.where(pos < 85, 0, np.where(pos < 170, (pos - 85) * 3, 0))
+    return pack_rgb(red, green, blue)
+
+
+RAINBOW_LUT = _build_rainbow_lut()
 
 
 class RainbowColors(Animation):
@@ -128,54 +250,73 @@ class RainbowColors(Animation):
 
     def __init__(self, strip):
         super().__init__(strip)
+        self.base_colors = RAINBOW_LUT[np.arange(self.strip.numPixels()) % 256]
 
     def __next__(self):
-        colors = deque([0 for _ in range(self.strip.getNumPixels())])
-        for i in range(self.strip.getNumPixels()):
-            if i < 85:
-                colors[i] = ws.Color(i * 3, 255 - i * 3, 0)
-            elif i < 170:
-                colors[i] = ws.Color(255 - (i - 85) * 3, 0, (i - 85) * 3)
-            else:
-                colors[i] = ws.Color((i - 170) * 3, 255 - (i - 170) * 3, 0)
-        colors.rotate(self.frame_number)
+        # Same as np.roll, but written straight into the frame.
+        shift = self.frame_number % len(self.base_colors)
+        self.frame.colors[shift:] = self.base_colors[: len(self.base_colors) - shift]
+        self.frame.colors[:shift] = self.base_colors[len(self.base_colors) - shift :]
         super().__next__()
-        return Frame(self.strip, colors)
+        return self.frame
 
 
 class ColorWipe(Animation):
-    def __init__(self, strip: ws.PixelStrip, color: ws.Color):
+    """
+    Wipe a colour along the strip, a few pixels each frame.
+
+    Parameters
+    ----------
+    strip
+        The strip to show the colour on
+    color
+        The 24-bit RGB colour to wipe on
+    pixels_per_frame
+        How many more pixels to light each frame. Each show costs the same
+        however few pixels change, so on long strips or short frame delays
+        it's cheaper to light several at once.
+    """
+
+    def __init__(
+        self, strip: ws.PixelStrip, color: ws.Color, pixels_per_frame: int = 1
+    ):
         super().__init__(strip)
         self.color = color
+        self.pixels_per_frame = max(1, pixels_per_frame)
 
     def __next__(self):
-        if self.frame_number >= self.strip.getNumPixels():
+        num_lit = self.frame_number * self.pixels_per_frame
+        if num_lit >= len(self.frame.colors):
             raise StopIteration
-        colors = [ws.Color(0, 0, 0) for _ in range(self.strip.getNumPixels())]
-        for i in range(self.frame_number):
-            colors[i] = self.color
+        num_lit += self.pixels_per_frame
+        self.frame.colors[:num_lit] = self.color
+        self.frame.colors[num_lit:] = 0
         super().__next__()
-        return Frame(self.strip, colors)
+        return self.frame
 
 
 class TheatreChase(Animation):
     """
-    Movie theatre style light cahse animation
+    Movie theatre style light chase animation
     """
 
     def __init__(self, strip: ws.PixelStrip, color: ws.Color, max_iterations: int = 10):
         super().__init__(strip)
         self.max_iterations = max_iterations
         self.color = color
+        self.first_pixels = np.arange(0, self.strip.numPixels(), 3)
+        self.lit_pixels = self.first_pixels.copy()
 
     def __next__(self):
         if self.frame_number >= self.max_iterations:
             raise StopIteration
-        colors = [ws.Color(0, 0, 0) for _ in range(self.strip.getNumPixels())]
-        for i in range(len(colors), 3):
-            colors[(i + self.frame_number) % len(colors)] = self.color
+        # Only the pixels lit last frame need turning off, not the whole strip.
+        self.frame.colors[self.lit_pixels] = 0
+        np.add(self.first_pixels, self.frame_number, out=self.lit_pixels)
+        np.remainder(self.lit_pixels, len(self.frame.colors), out=self.lit_pixels)
+        self.frame.colors[self.lit_pixels] = self.color
         super().__next__()
-        return Frame(self.strip, colors)
+        return self.frame
 
 
 class DitherFade(Animation):
@@ -191,23 +332,21 @@ class DitherFade(Animation):
         batch_size: int = 16,
     ):
         super().__init__(strip)
-        self.current_frame = copy.deepcopy(old_frame)
+        self.current_frame = old_frame.copy()
         self.new_frame = new_frame
         self.batch_size = batch_size
         rng = np.random.default_rng()
-        self.remaining_pixels = [i for i in range(self.strip.getNumPixels())]
+        self.remaining_pixels = np.arange(self.strip.numPixels())
         rng.shuffle(self.remaining_pixels)
+        self.cursor = 0
 
     def __next__(self):
-        if not self.remaining_pixels:
+        if self.cursor >= len(self.remaining_pixels):
             raise StopIteration
 
-        for _ in range(self.batch_size):
-            try:
-                idx = self.remaining_pixels.pop()
-            except IndexError:
-                break
-            self.current_frame.colors[idx] = self.new_frame.colors[idx]
+        batch = self.remaining_pixels[self.cursor : self.cursor + self.batch_size]
+        self.current_frame.colors[batch] = self.new_frame.colors[batch]
+        self.cursor += self.batch_size
         super().__next__()
         return self.current_frame
 
@@ -223,18 +362,19 @@ class LerpFade(Animation):
         super().__init__(strip)
         self.old_frame = old_frame
         self.new_frame = new_frame
-        self.delta = (new_frame.colors - old_frame.colors).astype(float) / steps
         self.steps = steps
+        # Build every step of the fade up front, so each frame is just a lookup.
+        self.table = _lerp_table(old_frame.colors, new_frame.colors, steps)
+        # The frames might not cover the whole strip, so match the table's width.
+        self.frame = Frame(strip, np.zeros(self.table.shape[1], dtype=np.uint32))
 
     def __next__(self):
         if self.frame_number >= self.steps:
             raise StopIteration
 
-        current_colors = self.old_frame.colors + (
-            self.delta * self.frame_number
-        ).astype(int)
+        self.frame.colors[:] = self.table[self.frame_number]
         super().__next__()
-        return Frame(self.strip, current_colors)
+        return self.frame
 
 
 class DitherLerpFade(Animation):
@@ -251,13 +391,14 @@ class DitherLerpFade(Animation):
         steps=255,
     ):
         super().__init__(strip)
-        self.delta = (new_frame.colors - old_frame.colors).astype(float) / steps
+        # One more row than steps, so that the last step lands on the new frame.
+        self.table = _lerp_table(old_frame.colors, new_frame.colors, steps + 1)
         self.steps = steps
         self.batch_size = batch_size
         self.remaining_pixels = self.get_random_pixels()
         self.lerp_step = 0
-        self.old_frame = copy.deepcopy(old_frame)
-        self.current_frame = copy.deepcopy(old_frame)
+        self.old_frame = old_frame.copy()
+        self.current_frame = old_frame.copy()
         self.next_frame = self.get_next_lerp_frame()
 
     def get_random_pixels(self, seed: Optional[int] = None) -> Iterable[int]:
@@ -274,7 +415,7 @@ class DitherLerpFade(Animation):
             list of pixel ids in a random order
         """
         rng = np.random.default_rng(seed=seed)
-        remaining_pixels = [i for i in range(self.strip.getNumPixels())]
+        remaining_pixels = [i for i in range(self.strip.numPixels())]
         rng.shuffle(remaining_pixels)
         return remaining_pixels
 
@@ -283,13 +424,12 @@ class DitherLerpFade(Animation):
         Get the next linearly interpolated frame
         """
         self.lerp_step += 1
-        return Frame(
-            self.strip,
-            self.old_frame.colors + (self.delta * self.lerp_step).astype(int),
-        )
+        return Frame(self.strip, self.table[self.lerp_step].copy())
 
     def __next__(self):
         if not self.remaining_pixels:
+            if self.lerp_step >= self.steps:
+                raise StopIteration
             self.current_frame = self.next_frame
             self.next_frame = self.get_next_lerp_frame()
             self.remaining_pixels = self.get_random_pixels()
@@ -304,49 +444,154 @@ class DitherLerpFade(Animation):
         return self.current_frame
 
 
+def dither_fade(
+    strip: ws.PixelStrip,
+    new_colors: Union[int, Iterable[int]],
+    leds_to_switch: Optional[Iterable[int]] = None,
+    dither_time: float = 1.0,
+    batch_size: int = 8,
+    min_frame_time: float = 1.0 / 60,
+):
+    """
+    Change a set of LEDs to new colours by switching a few random pixels at a time.
+
+    Parameters
+    ----------
+    strip
+        The strip to display on
+    new_colors
+        24-bit RGB colours to change to. Either a single colour for all the LEDs,
+        or an array with one colour per pixel on the strip.
+    leds_to_switch
+        The ids of the pixels to change, either a list or an array.
+        If None, change every pixel on the strip.
+    dither_time
+        How long the whole fade should take in seconds
+    batch_size
+        How many pixels to change between each update of the strip
+    min_frame_time
+        Shortest time between updates of the strip in seconds.
+        Batches that come round quicker than this are shown together.
+    """
+    num_pixels = strip.numPixels()
+    if leds_to_switch is None:
+        leds_to_switch = np.arange(num_pixels)
+    new_colors = np.asarray(new_colors, dtype=np.uint32)
+    if new_colors.ndim == 0:
+        new_colors = np.full(num_pixels, new_colors, dtype=np.uint32)
+
+    rng = np.random.default_rng()
+    leds_to_switch = rng.permutation(np.asarray(leds_to_switch, dtype=np.intp))
+    # Look up every colour in one go, in the order the pixels will change.
+    colors_to_set = new_colors[leds_to_switch].tolist()
+    leds_to_switch = leds_to_switch.tolist()
+
+    set_pixel_color = strip.setPixelColor
+    num_batches = max(1, -(-len(leds_to_switch) // batch_size))
+    batch_time = dither_time / num_batches
+    last_show = None
+    # Sleep until a fixed deadline for each batch, so that time spent
+    # updating the strip doesn't make the fade run long.
+    deadline = time.monotonic()
+    for start in range(0, len(leds_to_switch), batch_size):
+        end = start + batch_size
+        for led, color in zip(leds_to_switch[start:end], colors_to_set[start:end]):
+            set_pixel_color(led, color)
+        # Sending data down the strip takes a fixed time however little has
+        # changed, so don't show batches faster than anyone could see them.
+        now = time.monotonic()
+        is_last_batch = end >= len(leds_to_switch)
+        if is_last_batch or last_show is None or now - last_show >= min_frame_time:
+            strip.show()
+            last_show = now
+        deadline += batch_time
+        sleep_time = deadline - time.monotonic()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+
+SKYBLUE_RGB = np.array([135, 206, 235])
+SUNRISE_RGB = np.array([255, 191, 39])
+
+
 class SunriseAnimation(Animation):
+    """
+    A band of sunrise colour climbing along the strip, over a brightening sky.
+
+    Every frame is worked out up front in __init__, so playing
+    the animation is just a case of looking up each row.
+    """
+
     def __init__(self, strip, reverse=False, steps: int = 256):
         super().__init__(strip)
-        self.reverse = False
+        self.reverse = reverse
         self.steps = steps
+        self.table = self._build_table()
+
+    def _build_table(self) -> np.ndarray:
+        """
+        Build the packed colours for every step of the sunrise.
+
+        Returns
+        -------
+            (steps, N) uint32 array of packed colours
+        """
+        fracs = np.arange(self.steps) / self.steps
+        if self.reverse:
+            fracs = 1.0 - fracs
+        sky_rgb = np.maximum((fracs[:, None] * SKYBLUE_RGB).astype(np.uint32), 1)
+        sunrise_rgb = np.maximum((fracs[:, None] * SUNRISE_RGB).astype(np.uint32), 1)
+        skyblues = pack_rgb(sky_rgb[:, 0], sky_rgb[:, 1], sky_rgb[:, 2])
+        sunrises = pack_rgb(sunrise_rgb[:, 0], sunrise_rgb[:, 1], sunrise_rgb[:, 2])
+
+        num_pixels = self.strip.numPixels()
+        sunrise_width = int(num_pixels * 0.1)
+        sunrise_starts = (fracs * num_pixels).astype(int)[:, None]
+        pixel_ids = np.arange(num_pixels)[None, :]
+        is_sunrise = (pixel_ids >= sunrise_starts) & (
+            pixel_ids < sunrise_starts + sunrise_width
+        )
+        return np.where(is_sunrise, sunrises[:, None], skyblues[:, None])
 
     def __next__(self):
-        sunrise_width = int(self.strip.getNumPixels() * 0.1)
-        sunrise_start = (self.frame_number / steps) * self.strip.getNumPixels()
+        if self.frame_number >= self.steps:
+            raise StopIteration
+        self.frame.colors[:] = self.table[self.frame_number]
+        super().__next__()
+        return self.frame
 
 
 def sunrise_animation(strip, total_time=3600, reverse=False):
+    """
+    Play the sunrise, dithering between each step of SunriseAnimation.
+
+    Parameters
+    ----------
+    strip
+        The strip to display on
+    total_time
+        The time to take over the sunrise in seconds
+    reverse
+        Should this go dark->light (False) or light->dark (True)
+    """
     steps = 256
-    dither_time = total_time / 2
-    brightening_time = total_time - dither_time
-
-    for step in range(steps):
-        frac = step / steps
-        if reverse:
-            frac = 1.0 - frac
-        skyblue = ws.Color(
-            max(int(135 * frac), 1), max(int(206 * frac), 1), max(int(235 * frac), 1)
-        )
-        sunrise = ws.Color(
-            max(int(255 * frac), 1), max(int(191 * frac), 1), max(int(39 * frac), 1)
-        )
-        sunrise_width = int(strip.numPixels() * 0.1)
-        sunrise_start = int(frac * strip.numPixels())
-        sunrise_end = sunrise_start + sunrise_width
-        sky_pixels = [i for i in range(strip.numPixels())]
-        for pixel in range(sunrise_start, sunrise_end):
-            if pixel in sky_pixels:
-                sky_pixels.remove(pixel)
-            strip.setPixelColor(pixel, sunrise)
-        t_1 = time.time()
-        dither_fade(strip, skyblue, sky_pixels, (brightening_time - 1) / steps)
-        t_2 = time.time()
-        time_diff = t_2 - t_1
-        if time_diff < brightening_time / steps:
-            time.sleep((brightening_time / steps) - time_diff)
+    step_time = total_time / steps
+    previous_colors = None
+    for frame in SunriseAnimation(strip, reverse=reverse, steps=steps):
+        if previous_colors is None:
+            changed_pixels = None
+        else:
+            # Neighbouring steps are often identical while the colours are dim,
+            # so only dither the pixels that change, if there are any.
+            changed_pixels = np.flatnonzero(frame.colors != previous_colors)
+            if not changed_pixels.size:
+                time.sleep(step_time)
+                continue
+        dither_fade(strip, frame.colors, changed_pixels, dither_time=step_time)
+        previous_colors = frame.colors.copy()
     if reverse:
-        for pixel in range(strip.numPixels()):
-            strip.setPixelColor(pixel, 0)
+        clear(strip)
+        strip.show()
 
 
 if __name__ == "__main__":
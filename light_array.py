@@ -6,19 +6,17 @@ Created on Sun Dec 27 20:43:44 2020
 @author: matthew-bailey
 """
 
+import functools
+import hashlib
 import logging
 import os
-import pickle as pkl
-import time
+from typing import Dict, Iterable, Tuple, Union
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 from PIL import Image
 import scipy.spatial
-from sklearn.cluster import KMeans
 
-from led_animations import dither_fade
+from led_animations import dither_fade, pack_rgb
 
 logger = logging.getLogger(__name__)
 
@@ -33,28 +31,162 @@ except ImportError as ex:
     IS_STUB_WS = True
 
 
+COORDINATES_FILENAME = "./light_coordinates.csv"
+# Images are shrunk to at most this many pixels a side before sampling,
+# which is still plenty for a mean colour per light.
+SAMPLE_SIZE = 128
+# Part of every cached LightArray's name. Bump this whenever the way
+# _image_to_colors works out the colours changes, so old caches aren't used.
+CACHE_VERSION = 2
+# Below this many lights, it's quicker to check every light than to use a KD tree.
+BRUTE_FORCE_LIGHTS = 512
+
+
+def _cache_name(image_filename: str) -> str:
+    """
+    Get the name of the cached LightArray for a given image.
+
+    The name includes a hash of when the image was last changed, of the
+    LED positions themselves and of how the colours are worked out, so that a
+    stale cache is never picked up.
+    """
+    image_stat = os.stat(image_filename)
+    _, positions = load_light_positions()
+    key = hashlib.blake2b(digest_size=8)
+    key.update(
+        f"{CACHE_VERSION}|{SAMPLE_SIZE}|{image_filename}|"
+        f"{image_stat.st_mtime}|{image_stat.st_size}".encode()
+    )
+    key.update(positions.tobytes())
+    stem = os.path.splitext(os.path.basename(image_filename))[0]
+    return os.path.join("./pkl/", f"{stem}-{key.hexdigest()}.npz")
+
+
+@functools.lru_cache(maxsize=1)
+def load_light_positions(
+    filename: str = COORDINATES_FILENAME,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read the LED ids and positions from the coordinates file, keeping them for next time.
+
+    Parameters
+    ----------
+    filename
+        CSV file with at least ID, X and Y columns
+    Returns
+    -------
+    ids
+        The strip address of each LED
+    positions
+        Nx2 array of (Y, X) positions for each LED
+    """
+    data = np.genfromtxt(filename, delimiter=",", names=True)
+    ids = data["ID"].astype(np.intp)
+    positions = np.column_stack([data["Y"], data["X"]])
+    # These are shared between callers, so make sure nobody changes them.
+    ids.setflags(write=False)
+    positions.setflags(write=False)
+    return ids, positions
+
+
+_IMAGE_CACHE: Dict[str, Image.Image] = {}
+
+
+def load_image(image_filename: str) -> Image.Image:
+    """
+    Open and decode an image, keeping the result for next time.
+
+    Parameters
+    ----------
+    image_filename
+        The name of the image to load
+    Returns
+    -------
+        The fully decoded RGB image
+    """
+    if image_filename not in _IMAGE_CACHE:
+        with Image.open(image_filename) as image:
+            _IMAGE_CACHE[image_filename] = image.convert("RGB")
+    return _IMAGE_CACHE[image_filename]
+
+
+def preload_images(image_filenames: Iterable[str]):
+    """
+    Decode any images that we'd otherwise have to decode when they're displayed.
+
+    Images with a cached LightArray are skipped, as displaying them
+    never touches the image itself.
+
+    Parameters
+    ----------
+    image_filenames
+        The names of the images we might want to show
+    """
+    for image_filename in image_filenames:
+        if not os.path.exists(_cache_name(image_filename)):
+            load_image(image_filename)
+
+
+_GAMMA_LUT_CACHE: Dict[float, np.ndarray] = {}
+
+
 def gamma_adjust(colors: np.array, exponent: float = 2.2):
     """
     Taken in an RGB numpy array and adjust it with a gamma curve.
 
+    There are only 256 possible inputs, so the curve is worked out once
+    per exponent and then looked up.
+
     Parameters
     ----------
     colors
-        An RGB array in range [0, 255)
+        An RGB integer array in range [0, 255]
     exponent
         The gamma value, should be about 2.2 for sRGB
+    Returns
+    -------
+        uint8 array of the adjusted colours, rounded to the nearest integer
     """
-    return 255.0 * (np.asarray(colors) / 255.0) ** exponent
+    if exponent not in _GAMMA_LUT_CACHE:
+        _GAMMA_LUT_CACHE[exponent] = np.rint(
+            255.0 * (np.arange(256) / 255.0) ** exponent
+        ).astype(np.uint8)
+    return _GAMMA_LUT_CACHE[exponent][np.asarray(colors, dtype=np.uint8)]
+
+
+@functools.lru_cache(maxsize=4)
+def _brightness_lut(num_steps: int, exponent: float) -> np.ndarray:
+    """
+    Build a table of every 8-bit colour value scaled by every brightness step.
+
+    Parameters
+    ----------
+    num_steps
+        The number of brightness steps
+    exponent
+        The exponent of the brightness curve
+    Returns
+    -------
+        (num_steps, 256) uint8 array, where lut[step, value] is the
+        rounded value of value * (step / num_steps) ** exponent
+    """
+    scales = (np.arange(num_steps) / num_steps) ** exponent
+    return np.rint(scales[:, None] * np.arange(256)[None, :]).astype(np.uint8)
+
+
+_REGIONS_CACHE: Dict[Tuple[bytes, int, int], np.ndarray] = {}
 
 
 class LightArray:
-    def __init__(self, position_data, image_filename):
+    def __init__(self, position_data, image: Union[str, Image.Image]):
         """
         Calculate the KD Tree for these pixels, to find which regions are closest
         to each pixel and no others
+
+        The image can be either a filename or an already decoded image.
         """
         assert position_data.shape[1] == 2, "Pixel positions must be a 2D array"
-        position_data = np.asarray(position_data, dtype=float)
+        position_data = np.array(position_data, dtype=float)
         # Normalise the position data before using it further
         position_data[:, 0] /= np.max(position_data[:, 0])
         position_data[:, 1] /= np.max(position_data[:, 1])
@@ -63,14 +195,88 @@ class LightArray:
             position_data, compact_nodes=True, copy_data=True
         )
 
-        image = Image.open(image_filename)
+        if isinstance(image, str):
+            image = load_image(image)
         self.colors = self._image_to_colors(image)
 
+    @classmethod
+    def from_npz(cls, filename: str) -> "LightArray":
+        """
+        Load a LightArray saved by to_npz, without having to look at the image again.
+
+        Parameters
+        ----------
+        filename
+            The .npz file to load
+        Returns
+        -------
+            The LightArray with the saved colours and positions
+        """
+        obj = cls.__new__(cls)
+        with np.load(filename) as data:
+            obj.colors = data["colors"]
+            obj._packed = data["packed"]
+            obj.kdtree = scipy.spatial.cKDTree(
+                data["positions"], compact_nodes=True, copy_data=True
+            )
+        return obj
+
+    def to_npz(self, filename: str):
+        """
+        Save the arrays of this LightArray, as they are quicker to load than a pickle.
+
+        Parameters
+        ----------
+        filename
+            The .npz file to write
+        """
+        with open(filename, "wb") as fi:
+            np.savez(
+                fi,
+                colors=self.colors,
+                packed=self.packed,
+                positions=self.kdtree.data,
+            )
+
+    def _pixel_regions(self, width: int, height: int) -> np.ndarray:
+        """
+        Find which light each pixel of an image of this size is closest to.
+
+        This only depends on the light positions and the image size, so it is
+        shared between LightArrays with the same lights.
+
+        Parameters
+        ----------
+        width, height
+            The size of the image in pixels
+        Returns
+        -------
+            The index of the closest light for each pixel
+        """
+        key = (self.kdtree.data.tobytes(), width, height)
+        if key not in _REGIONS_CACHE:
+            xs = np.arange(width, dtype=np.float32) / width
+            ys = np.arange(height, dtype=np.float32) / height
+            # Row-major like the image data, with each light's (Y, X) position
+            # compared against each pixel's (row, column).
+            grid = np.meshgrid(ys, xs, indexing="ij")
+            pixel_positions = np.stack(grid, axis=-1).reshape(-1, 2)
+            lights = self.kdtree.data.astype(np.float32)
+            if lights.shape[0] <= BRUTE_FORCE_LIGHTS:
+                # Comparing every pixel with every light is one matrix multiply.
+                # The squared distance of each pixel is the same for every light,
+                # so it can be left out of the comparison.
+                dists = (lights * lights).sum(axis=1) - 2 * pixel_positions @ lights.T
+                regions = np.argmin(dists, axis=1)
+            else:
+                _, regions = self.kdtree.query(pixel_positions, workers=-1)
+            _REGIONS_CACHE[key] = regions
+        return _REGIONS_CACHE[key]
+
     def _image_to_colors(self, image):
         """
         Take in an image and figure out what colours the pixels in this array should be.
-        Each pixel takes the colour of the most significant cluster of pixel colours
-        in the region closest to it.
+        Each pixel takes the mean colour of the region of the image closest to it.
 
         Parameters
         ----------
@@ -81,21 +287,37 @@ class LightArray:
         colors
             Nx3 RGB array of colour data
         """
-        pixel_positions = np.array(
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if max(image.width, image.height) > SAMPLE_SIZE:
+            image = image.resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.BILINEAR)
+        regions = self._pixel_regions(image.width, image.height)
+        color_data = np.asarray(image, dtype=np.uint8).reshape(-1, 3)
+        # A single KMeans cluster is just the mean, so sum up each region in one pass.
+        num_regions = self.kdtree.data.shape[0]
+        counts = np.bincount(regions, minlength=num_regions)
+        sums = np.stack(
             [
-                [x / image.width, y / image.height]
-                for x in range(image.width)
-                for y in range(image.height)
-            ]
+                np.bincount(
+                    regions, weights=color_data[:, channel], minlength=num_regions
+                )
+                for channel in range(3)
+            ],
+            axis=1,
         )
-        _, regions = self.kdtree.query(pixel_positions)
-        color_data = np.array(image.getdata())
-        ret_colors = np.zeros([self.kdtree.data.shape[0], 3], dtype=int)
-        for region in range(min(regions), max(regions)):
-            colors_in_region = color_data[regions == region]
-            kmeans = KMeans(n_clusters=1, random_state=0).fit(colors_in_region)
-            ret_colors[region, :] = [int(item) for item in kmeans.cluster_centers_[0]]
-        return ret_colors
+        # Any region without image pixels in stays black.
+        return (sums / np.maximum(counts, 1)[:, None]).astype(np.uint8)
+
+    @property
+    def packed(self) -> np.ndarray:
+        """
+        The colours packed into 24-bit ints, worked out the first time they're needed.
+        """
+        if getattr(self, "_packed", None) is None:
+            self._packed = pack_rgb(
+                self.colors[:, 0], self.colors[:, 1], self.colors[:, 2]
+            )
+        return self._packed
 
     def image_to_strip(self, strip, ids):
         """
@@ -110,11 +332,9 @@ class LightArray:
         ids
             The index array linking the colours to the pixel addresses
         """
-        for i in range(self.colors.shape[0]):
-            this_color = ws.Color(
-                int(self.colors[i, 0]), int(self.colors[i, 1]), int(self.colors[i, 2])
-            )
-            strip.setPixelColor(int(ids[i]), this_color)
+        set_pixel_color = strip.setPixelColor
+        for pixel_id, color in zip(np.asarray(ids).tolist(), self.packed.tolist()):
+            set_pixel_color(pixel_id, color)
         strip.show()
         return strip
 
@@ -145,14 +365,43 @@ class LightArray:
         else:
             steps = range(NUM_STEPS)
 
+        ids = np.asarray(ids, dtype=np.intp)
+        colors = np.asarray(self.colors, dtype=np.uint8)
+        # Work out every step of the ramp up front, so each step is just a row lookup.
+        ramp = _brightness_lut(NUM_STEPS, 2.3)[:, colors]
+        packed_ramp = pack_rgb(ramp[..., 0], ramp[..., 1], ramp[..., 2])
+        frame = np.zeros(strip.numPixels(), dtype=np.uint32)
         for step in steps:
-            color_arr = [ws.Color(0, 0, 0) for _ in range(strip.numPixels())]
-            interp_colors = self.colors * (step / NUM_STEPS) ** 2.3
-            for i in range(self.colors.shape[0] - 1, 0, -1):
-                color_arr[int(ids[i])] = ws.Color(
-                    *[int(round(item)) for item in interp_colors[i, :]]
-                )
-            dither_fade(strip, color_arr, dither_time=TIME_PER_STEP)
+            frame[ids] = packed_ramp[step]
+            dither_fade(strip, frame, dither_time=TIME_PER_STEP)
+
+
+@functools.lru_cache(maxsize=8)
+def get_light_array(image_filename: str) -> LightArray:
+    """
+    Get the LightArray for an image, keeping it for the next time it's shown.
+
+    Uses a cached .npz file as building one is expensive on the Raspberry Pi.
+    Coordinates of lights should be available in light_coordinates.csv
+
+    Parameters
+    ----------
+    image_filename
+        The name of the image to show
+    Returns
+    -------
+        The LightArray of that image's colours
+    """
+    cache_name = _cache_name(image_filename)
+    if os.path.exists(cache_name):
+        logger.info(f"Using cached {cache_name}")
+        return LightArray.from_npz(cache_name)
+
+    _, light_arr = load_light_positions()
+    la = LightArray(light_arr, image_filename)
+    logger.info(f"Saving new cache {cache_name}")
+    la.to_npz(cache_name)
+    return la
 
 
 def display_image(
@@ -161,7 +410,6 @@ def display_image(
     """
     Display a given image on the strip.
 
-    Uses a cached pickle file as this is expensive on the Raspberry Pi.
     Parameters
     ---------
     strip
@@ -174,48 +422,26 @@ def display_image(
     reverse
         Should we go from dark->bright(False) or bright->dark (True)
     """
-    _pkl_name = os.path.join("./pkl/", os.path.splitext(image_filename)[0] + ".pkl")
-
-    light_pos = pd.read_csv("./light_coordinates.csv")
-    if os.path.exists(_pkl_name):
-        logger.info(f"Using pickled {_pkl_name}")
-        with open(_pkl_name, "rb") as fi:
-            la = pkl.load(fi)
-    else:
-        light_arr = np.vstack(
-            [
-                light_pos["Y"].to_numpy(),
-                light_pos["X"].to_numpy(),
-            ]
-        ).T
-        la = LightArray(light_arr, image_filename)
-        logger.info(f"Dumping new pickled {_pkl_name}")
-        with open(_pkl_name, "wb") as fi:
-            pkl.dump(la, fi)
-
-    la.blend_image_to_strip(
-        strip=strip, ids=light_pos["ID"], runtime=runtime, reverse=reverse
+    light_ids, _ = load_light_positions()
+    get_light_array(image_filename).blend_image_to_strip(
+        strip=strip, ids=light_ids, runtime=runtime, reverse=reverse
     )
 
 
 if __name__ == "__main__":
-    LIGHT_POS = pd.read_csv("./light_coordinates.csv")
-    LIGHT_ARR = np.vstack(
-        [
-            LIGHT_POS["Y"].to_numpy(),
-            LIGHT_POS["X"].to_numpy(),
-        ]
-    ).T
+    LIGHT_IDS, LIGHT_ARR = load_light_positions()
     la = LightArray(LIGHT_ARR, "./thunderstorm.jpg")
     NUM_LEDS = 150
     LED_PIN = 18
     RUNTIME = 20 * 60
     STRIP = ws.PixelStrip(NUM_LEDS, LED_PIN)
     STRIP.begin()
-    la.image_to_strip(STRIP, LIGHT_POS["ID"])
+    la.image_to_strip(STRIP, LIGHT_IDS)
 
     if IS_STUB_WS:
+        import matplotlib.pyplot as plt
+
         print("Saving to plotted.pdf")
         fig, ax = plt.subplots()
-        ax = STRIP.plot_onto(LIGHT_ARR, LIGHT_POS["ID"], ax)
+        ax = STRIP.plot_onto(LIGHT_ARR, LIGHT_IDS, ax)
         fig.savefig("./plotted.pdf")
@@ -7,27 +7,56 @@ Created on Thurs Sep 01 17:49:27 2022
 
 @author: matthew-bailey
 """
+
 from collections import defaultdict
-from light_array import display_image
-
-weather_animations = defaultdict(lambda: sunrise_animation)
-weather_animations["Clear"] = lambda strip, runtime, reverse: display_image(
-    strip=strip, image_filename="sunrise.jpg", runtime=runtime, reverse=reverse
-)
-weather_animations["Rain"] = lambda strip, runtime, reverse: display_image(
-    strip=strip, image_filename="rain.jpg", runtime=runtime, reverse=reverse
-)
-
-weather_animations["Snow"] = lambda strip, runtime, reverse: display_image(
-    strip=strip, image_filename="snow.jpg", runtime=runtime, reverse=reverse
-)
-weather_animations["Thunderstorm"] = lambda strip, runtime, reverse: display_image(
-    strip=strip, image_filename="thunderstorm.jpg", runtime=runtime, reverse=reverse
-)
-weather_animations["Drizzle"] = lambda strip, runtime, reverse: display_image(
-    strip=strip, image_filename="drizzle.jpeg", runtime=runtime, reverse=reverse
-)
-
-weather_animations["Clouds"] = lambda strip, runtime, reverse: display_image(
-    strip=strip, image_filename="clouds.jpeg", runtime=runtime, reverse=reverse
-)
+from typing import Callable, DefaultDict
+
+from led_animations import sunrise_animation
+from light_array import display_image, preload_images
+
+WEATHER_IMAGES = {
+    "Clear": "sunrise.jpg",
+    "Rain": "rain.jpg",
+    "Snow": "snow.jpg",
+    "Thunderstorm": "thunderstorm.jpg",
+    "Drizzle": "drizzle.jpeg",
+    "Clouds": "clouds.jpeg",
+}
+
+
+def _default_animation(strip, runtime, reverse):
+    """
+    Show the plain sunrise for weather we don't have an image for.
+    """
+    return sunrise_animation(strip, total_time=runtime, reverse=reverse)
+
+
+def _image_animation(image_filename: str) -> Callable:
+    """
+    Make an animation that fades the given image in or out.
+    """
+
+    def animation(strip, runtime, reverse):
+        return display_image(
+            strip=strip, image_filename=image_filename, runtime=runtime, reverse=reverse
+        )
+
+    return animation
+
+
+def build_weather_animations() -> DefaultDict[str, Callable]:
+    """
+    Build the table of animations to play for each OpenWeatherMap status.
+
+    Each animation takes (strip, runtime, reverse).
+    """
+    animations = defaultdict(lambda: _default_animation)
+    for weather, image_filename in WEATHER_IMAGES.items():
+        animations[weather] = _image_animation(image_filename)
+    return animations
+
+
+weather_animations = build_weather_animations()
+
+# Decode the images now rather than when the alarm goes off.
+preload_images(WEATHER_IMAGES.values())
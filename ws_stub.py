@@ -9,8 +9,6 @@ Created on Sun Dec 27 19:41:44 2020
 """
 
 import numpy as np
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 from scipy.spatial import Voronoi
 
 
@@ -49,13 +47,22 @@ def Color(red: int, green: int, blue: int, white: int = 0):
 
 
 def color_to_rgb(color):
-    return (
-        np.array(
-            [(color >> 16) & 0xFF, (color >> 8) & 0xFF, (color >> 0) & 0xFF, 1.0],
-            dtype=float,
-        )
-        / 255
+    """
+    Convert 24-bit color values to RGBA in the range [0, 1] for matplotlib.
+
+    Works on a single color or an array of them, adding a last axis of length 4.
+    """
+    color = np.asarray(color, dtype=np.uint32)
+    rgba = np.stack(
+        [
+            (color >> 16) & 0xFF,
+            (color >> 8) & 0xFF,
+            color & 0xFF,
+            np.full_like(color, 255),
+        ],
+        axis=-1,
     )
+    return rgba / 255
 
 
 class PixelStrip:
@@ -63,6 +70,9 @@ class PixelStrip:
         self.num = num
         self.pin = pin
         self._data = np.zeros([self.num], dtype=int)
+        # The Voronoi polygons only depend on the points, so keep the last ones.
+        self._polygon_key = None
+        self._polygons = None
 
     def begin(self):
         return True
@@ -77,34 +87,49 @@ class PixelStrip:
     def getNumPixels(self):
         return self._data.shape[0]
 
-    def plot_onto(self, points, ids, ax=None):
-        print(self._data.shape, points.shape)
-        if ax is None:
-            fig, ax = plt.subplots()
+    def numPixels(self):
+        return self._data.shape[0]
 
-        vor = Voronoi(points)
+    def getPixels(self):
+        # rpi_ws281x 5.x hands back a copy, so writing to this must not change the strip.
+        return self._data.copy()
+
+    def _voronoi_polygons(self, points):
+        """
+        Get the Voronoi cell around each point, closing off the cells at the edge.
 
-        polys = []
-        name_order = []
+        The result is kept until this is called with different points.
+        """
+        key = np.asarray(points, dtype=float).tobytes()
+        if self._polygon_key == key:
+            return self._polygons
 
-        all_ridges: Dict[int, List[int]] = {}
-        for (p1, p2), (v1, v2) in zip(vor.ridge_points, vor.ridge_vertices):
-            all_ridges.setdefault(p1, []).append((p2, v1, v2))
-            all_ridges.setdefault(p2, []).append((p1, v1, v2))
+        vor = Voronoi(points)
+
+        # Group the ridges by the point on each side of them, so that
+        # ridge_ids[starts[p]:starts[p + 1]] are the ridges around point p.
+        ridge_points = vor.ridge_points
+        num_ridges = ridge_points.shape[0]
+        this_point = np.concatenate([ridge_points[:, 0], ridge_points[:, 1]])
+        other_point = np.concatenate([ridge_points[:, 1], ridge_points[:, 0]])
+        ridge_ids = np.tile(np.arange(num_ridges), 2)
+        order = np.argsort(this_point, kind="stable")
+        other_point, ridge_ids = other_point[order], ridge_ids[order]
+        starts = np.searchsorted(this_point[order], np.arange(len(vor.points) + 1))
+        midpoints = vor.points[vor.ridge_points].mean(axis=1)
         center = vor.points.mean(axis=0)
-        radius = max(vor.points[:, 0].ptp(), vor.points[:, 1].ptp())
+        radius = np.ptp(vor.points, axis=0).max()
 
+        polygons = []
         for region_id, point_region in enumerate(vor.point_region):
             # Create the polygons
             vertices = vor.regions[point_region]
-            coords_list = [
-                np.array([vor.vertices[vertex][0], vor.vertices[vertex][1]])
-                for vertex in vertices
-                if vertex >= 0
-            ]
+            coords_list = [vor.vertices[vertex] for vertex in vertices if vertex >= 0]
             if -1 in vertices:
                 # reconstruct a non-finite region
-                for p2, v1, v2 in all_ridges[region_id]:
+                start, end = starts[region_id], starts[region_id + 1]
+                for p2, ridge_idx in zip(other_point[start:end], ridge_ids[start:end]):
+                    v1, v2 = vor.ridge_vertices[ridge_idx]
                     if v2 < 0:
                         v1, v2 = v2, v1
                     if v1 >= 0:
@@ -116,19 +141,36 @@ class PixelStrip:
                     t /= np.linalg.norm(t)
                     n = np.array([-t[1], t[0]])  # normal
 
-                    midpoint = vor.points[[region_id, p2]].mean(axis=0)
+                    midpoint = midpoints[ridge_idx]
                     direction = np.sign(np.dot(midpoint - center, n)) * n
                     far_point = vor.vertices[v2] + direction * radius
                     coords_list.append(far_point)
 
-            coordinates = sort_coordinates_anticlockwise(np.vstack(coords_list))
-            polys.append(
-                mpl.patches.Polygon(coordinates, linewidth=1.0, edgecolor="black")
-            )
+            polygons.append(sort_coordinates_anticlockwise(np.vstack(coords_list)))
+
+        self._polygon_key = key
+        self._polygons = polygons
+        return polygons
+
+    def plot_onto(self, points, ids, ax=None):
+        # Only needed for plotting, so don't make every user of the stub import it.
+        import matplotlib as mpl
+        import matplotlib.collections
+        import matplotlib.patches
+        import matplotlib.pyplot as plt
+
+        print(self._data.shape, points.shape)
+        if ax is None:
+            fig, ax = plt.subplots()
+
+        polys = [
+            mpl.patches.Polygon(coordinates, linewidth=1.0, edgecolor="black")
+            for coordinates in self._voronoi_polygons(points)
+        ]
         polys = mpl.collections.PatchCollection(
             polys, alpha=1.0, linewidth=0.0, edgecolor=None
         )
-        polys.set_facecolors([color_to_rgb(self._data[idx]) for idx in ids])
+        polys.set_facecolors(color_to_rgb(self._data[ids]))
         ax.add_collection(polys)
         ax.set_xlim(0, max(points[:, 0]) * 1.1)
         ax.set_ylim(0, max(points[:, 1]) * 1.1)